@@ -1,26 +1,191 @@
 # graphhopper_ui.py
 import streamlit as st
-import requests
-import urllib.parse
+import diskcache
+import hashlib
+import httpx
+import json
+import ijson
+import math
+import numpy as np
 import pandas as pd
-from typing import Tuple, Dict
+import pydeck as pdk
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Dict, List, Optional
 
 st.set_page_config(page_title="GraphHopper Routing UI", layout="wide")
 
 # --- Helpers -----------------------------------------------------------------
 GRAPHOPPER_GEOCODE = "https://graphhopper.com/api/1/geocode"
 GRAPHOPPER_ROUTE = "https://graphhopper.com/api/1/route"
+GRAPHOPPER_INFO = "https://graphhopper.com/api/1/info"
 
-@st.cache_data(show_spinner=False)
-def geocode_location(location: str, api_key: str) -> Tuple[int, dict]:
+# query parameters that never change between calls
+_GEOCODE_STATIC_PARAMS = (("limit", "1"),)
+_ROUTE_STATIC_PARAMS = (("instructions", "true"),)
+# raw coordinates rather than an encoded polyline, so no per-character decode is needed
+_ROUTE_POLYLINE_PARAMS = (("calc_points", "true"), ("points_encoded", "false"))
+_ROUTE_NO_POLYLINE_PARAMS = (("calc_points", "false"),)
+
+@st.cache_resource(show_spinner=False)
+def _get_client() -> httpx.Client:
+    """
+    Shared HTTP/2 client for all GraphHopper calls.
+    Keeps connections to graphhopper.com alive between calls, and HTTP/2 lets
+    requests share one connection, so only the first request pays for the TCP+TLS
+    handshake. Cached as a resource so it survives reruns.
+    """
+    limits = httpx.Limits(max_keepalive_connections=10, max_connections=20)
+    # transport retries cover connection failures; status retries are in _request
+    transport = httpx.HTTPTransport(http2=True, limits=limits, retries=3)
+    return httpx.Client(transport=transport, timeout=15.0)
+
+_HX = _get_client()
+
+# rate limits and transient server errors are retried with exponential backoff
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_RETRY_TOTAL = 3
+_RETRY_BACKOFF = 0.3  # seconds; doubles on each attempt
+
+def _request(url: str, params, timeout: float, stream: bool = False) -> httpx.Response:
+    """
+    GET through the shared client, retrying _RETRY_STATUSES with backoff.
+    The last response is returned whatever its status. With stream=True the body is
+    left unread and the caller must close the response.
+    """
+    request = _HX.build_request("GET", url, params=params, timeout=timeout)
+    for attempt in range(_RETRY_TOTAL + 1):
+        resp = _HX.send(request, stream=True)
+        if resp.status_code not in _RETRY_STATUSES or attempt == _RETRY_TOTAL:
+            break
+        resp.close()
+        time.sleep(_RETRY_BACKOFF * 2 ** attempt)
+    if not stream:
+        try:
+            resp.read()
+        finally:
+            resp.close()
+    return resp
+
+@st.cache_resource(show_spinner=False)
+def _get_disk_cache() -> diskcache.Cache:
+    """
+    On-disk geocode cache, so results survive server restarts and deploys.
+    """
+    return diskcache.Cache(".ghcache", size_limit=2**28)
+
+_DCACHE = _get_disk_cache()
+# bump to invalidate persisted geocode results when their shape changes
+_DCACHE_VERSION = "v1"
+_DCACHE_EXPIRE = 30 * 86400  # seconds
+
+def _lru_get(store: Tuple[OrderedDict, threading.Lock], key):
+    """
+    Look up key in an (OrderedDict, Lock) store, marking it most recently used.
+    Returns None on a miss.
+    """
+    data, lock = store
+    with lock:
+        value = data.get(key)
+        if value is not None:
+            data.move_to_end(key)
+        return value
+
+def _lru_put(store: Tuple[OrderedDict, threading.Lock], key, value, maxsize: int) -> None:
     """
-    Geocode a location string using GraphHopper Geocoding API.
-    Returns: (status_code, data)
+    Insert into an (OrderedDict, Lock) store, evicting least recently used entries.
+    """
+    data, lock = store
+    with lock:
+        data[key] = value
+        data.move_to_end(key)
+        while len(data) > maxsize:
+            data.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def _validate_key(api_key: str) -> bool:
+    """
+    One cheap request to check the API key before geocoding and routing.
+    Cached per key, so reruns with the same key cost no network traffic.
+    """
+    resp = _request(GRAPHOPPER_INFO, params={"key": api_key}, timeout=5)
+    # only an explicit auth rejection counts as a bad key; anything else is
+    # left for the real calls to report
+    return resp.status_code not in (401, 403)
+
+def _key_hash(api_key: str) -> str:
+    """
+    Short digest of the API key, used in cache keys so the raw key is never stored.
+    """
+    return hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest()
+
+def _normalize(loc: str) -> str:
+    """
+    Canonical form of a location query: lowercase, single spaces, ", " between parts.
+    "Manila, Philippines" and " manila,philippines " both become "manila, philippines".
+    """
+    parts = (" ".join(part.split()) for part in loc.lower().split(","))
+    return ", ".join(part for part in parts if part)
+
+def geocode_many(locations: List[str], api_key: str) -> List[Tuple[int, dict]]:
+    """
+    Geocode several location strings using GraphHopper Geocoding API.
+    Returns one (status_code, data) per location, in order.
     data contains: lat, lng, name, osm_value, state, country (when available)
     """
-    params = {"q": location, "limit": "1", "key": api_key}
-    url = GRAPHOPPER_GEOCODE + "?" + urllib.parse.urlencode(params)
-    resp = requests.get(url, timeout=10)
+    # normalize first so trivially different spellings share one cache entry
+    queries = [_normalize(loc) for loc in locations]
+    unique = list(dict.fromkeys(queries))
+    key_hash = _key_hash(api_key)
+    memo = _geocode_cache()
+
+    def geocode_one(query: str) -> Tuple[int, dict]:
+        cached = _lru_get(memo, (query, key_hash))
+        if cached is not None:
+            return 200, cached
+        status, data = _geocode_impl(query, api_key)
+        # failures are not memoized so a transient 429/5xx is retried next time
+        if status == 200:
+            _lru_put(memo, (query, key_hash), data, _GEOCODE_CACHE_SIZE)
+        return status, data
+
+    # misses run side by side; the shared HTTP/2 client multiplexes them on one connection
+    with ThreadPoolExecutor(max_workers=max(1, min(len(unique), 4))) as ex:
+        results = dict(zip(unique, ex.map(geocode_one, unique)))
+    return [results[q] for q in queries]
+
+_GEOCODE_CACHE_SIZE = 2048  # entries
+
+@st.cache_resource(show_spinner=False)
+def _geocode_cache() -> Tuple[OrderedDict, threading.Lock]:
+    """
+    Process-wide in-memory LRU of successful geocode lookups, keyed by
+    (normalized query, API key digest); use with _lru_get / _lru_put.
+    It holds only data, never functions, so every rerun's current code does the lookup,
+    and a hit is a dict access without cache_data's argument hashing and pickling.
+    """
+    return OrderedDict(), threading.Lock()
+
+def _geocode_impl(location: str, api_key: str) -> Tuple[int, dict]:
+    """
+    Geocode one normalized query: disk cache first, then the API.
+    """
+    cached = _DCACHE.get((location, _DCACHE_VERSION))
+    if cached is not None:
+        return 200, cached
+    params = list(_GEOCODE_STATIC_PARAMS) + [("q", location), ("key", api_key)]
+    resp = _request(GRAPHOPPER_GEOCODE, params=params, timeout=10)
+    status, data = _parse_geocode(resp, location)
+    if status == 200:
+        _DCACHE.set((location, _DCACHE_VERSION), data, expire=_DCACHE_EXPIRE)
+    return status, data
+
+def _parse_geocode(resp, location: str) -> Tuple[int, dict]:
+    """
+    Turn a geocoding HTTP response into (status_code, data).
+    """
     try:
         j = resp.json()
     except Exception:
@@ -41,27 +206,125 @@ def geocode_location(location: str, api_key: str) -> Tuple[int, dict]:
         "raw": hit
     }
 
-@st.cache_data(show_spinner=False)
-def get_route(start: Tuple[float, float], end: Tuple[float, float], vehicle: str, api_key: str) -> Tuple[int, dict]:
+_ROUTE_CACHE_SIZE = 256  # entries; each holds the route JSON, a DataFrame and the bytes
+
+@st.cache_resource(show_spinner=False)
+def _route_cache() -> Tuple[OrderedDict, threading.Lock]:
+    """
+    Process-wide LRU of routing responses, their instruction tables and JSON downloads,
+    shared by all sessions (hence the lock); use with _lru_get / _lru_put.
+    Unlike st.cache_data, hits are returned by reference instead of being
+    unpickled again on every rerun, which matters for large route JSON.
+    """
+    return OrderedDict(), threading.Lock()
+
+def get_route(start: Tuple[float, float], end: Tuple[float, float], vehicle: str, api_key: str,
+              want_polyline: bool = False) -> Tuple[int, dict, Optional[pd.DataFrame], Optional[bytes]]:
     """
     Request routing from GraphHopper.
     start and end are (lat, lng).
-    Returns (status_code, json_data)
-    """
-    # GraphHopper expects &point=lat,lng multiple times
-    params = {"key": api_key, "vehicle": vehicle}
-    base = GRAPHOPPER_ROUTE + "?" + urllib.parse.urlencode(params)
-    op = f"&point={start[0]},{start[1]}"
-    dp = f"&point={end[0]},{end[1]}"
-    # ask for instructions and alternative attributes
-    extra = "&instructions=true&calc_points=true&points_encoded=true"
-    url = base + op + dp + extra
-    resp = requests.get(url, timeout=15)
+    want_polyline: also return the route geometry (only needed to draw the path).
+    Returns (status_code, json_data, instructions_df, json_bytes); on success json_data is
+    {"paths": [first_path]}, instructions_df is the table built by _instructions_frame
+    (None when there are no instructions) and json_bytes is the download payload.
+    Both are cached with the response; on failure they are None.
+    """
+    cache_key = (start, end, vehicle, want_polyline, _key_hash(api_key))
+    cached = _lru_get(_route_cache(), cache_key)
+    if cached is not None:
+        return cached
+
+    # GraphHopper expects point=lat,lng multiple times, so pass a list of pairs
+    # and let httpx do the encoding.
+    # The geometry is the bulk of the payload; skip it unless it will be drawn.
+    query = list(_ROUTE_STATIC_PARAMS) + [
+        ("key", api_key),
+        ("vehicle", vehicle),
+        ("point", f"{start[0]},{start[1]}"),
+        ("point", f"{end[0]},{end[1]}"),
+    ]
+    query += _ROUTE_POLYLINE_PARAMS if want_polyline else _ROUTE_NO_POLYLINE_PARAMS
+    resp = _request(GRAPHOPPER_ROUTE, params=query, timeout=15, stream=True)
     try:
-        j = resp.json()
-    except Exception:
-        j = {}
-    return resp.status_code, j
+        if resp.status_code != 200:
+            resp.read()
+            try:
+                j = resp.json()
+            except Exception:
+                j = {}
+            return resp.status_code, j, None, None
+        # parse only the first path off the wire and stop reading there
+        first = _first_route_path(resp.iter_bytes())
+    except Exception as e:
+        # a 200 whose body broke off or was not JSON is a failed request, not a route
+        return 502, {"message": f"Could not read routing response: {e}"}, None, None
+    finally:
+        resp.close()
+    if first is None:
+        return resp.status_code, {"paths": []}, None, None
+    # build the instruction table and download bytes once here so reruns reuse them
+    j = {"paths": [first]}
+    instr = first.get("instructions", [])
+    result = (resp.status_code, j, _instructions_frame(instr) if instr else None, _serialize_json(j))
+    # only complete, parsed routes are kept so anything else can be retried
+    _lru_put(_route_cache(), cache_key, result, _ROUTE_CACHE_SIZE)
+    return result
+
+def _first_route_path(chunks) -> Optional[dict]:
+    """
+    Feed response body chunks to ijson and return the first element of "paths"
+    as soon as it is complete, without reading the rest of the body.
+    Returns None for a complete body with no paths; raises on truncated or invalid JSON.
+    """
+    found = ijson.sendable_list()
+    parser = ijson.items_coro(found, "paths.item", use_float=True)
+    for chunk in chunks:
+        parser.send(chunk)
+        if found:
+            return found[0]
+    # the whole body was read without a path; closing flushes the parser and
+    # raises IncompleteJSONError if the body ended early
+    parser.close()
+    return found[0] if found else None
+
+def _route_coords(path: dict) -> Optional[np.ndarray]:
+    """
+    Route geometry as an (N, 2) array of [lon, lat], or None if the path has no points.
+    Expects points_encoded=false, i.e. GeoJSON coordinates (lon, lat[, elevation]).
+    """
+    points = path.get("points")
+    if not isinstance(points, dict) or not points.get("coordinates"):
+        return None
+    # one vectorized conversion; the slice drops elevation when present
+    return np.asarray(points["coordinates"], dtype=np.float64)[:, :2]
+
+def _instructions_frame(instr: list) -> pd.DataFrame:
+    """
+    Table of turn-by-turn instructions: text, distance in km and miles, hh:mm:ss.
+    Distance and time math is done on whole NumPy arrays rather than per row.
+    """
+    n = len(instr)
+    d = np.fromiter((ins.get("distance", 0.0) for ins in instr), dtype=np.float64, count=n)
+    t = np.fromiter((ins.get("time", 0) for ins in instr), dtype=np.float64, count=n)
+    km = d * 1e-3
+    mi = km * (1 / 1.609344)
+    tsec = t.astype(np.int64) // 1000
+    hh = pd.Series(tsec // 3600).astype(str).str.zfill(2)
+    mm = pd.Series((tsec % 3600) // 60).astype(str).str.zfill(2)
+    ss = pd.Series(tsec % 60).astype(str).str.zfill(2)
+    return pd.DataFrame({
+        "#": np.arange(1, n + 1),
+        "text": [ins.get("text", "(no text)") for ins in instr],
+        "km": km,
+        "mi": mi,
+        "hh:mm:ss": hh + ":" + mm + ":" + ss,
+    })
+
+def _serialize_json(obj: dict) -> bytes:
+    """
+    Compact JSON bytes for the download button; get_route caches them with the response.
+    """
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
 
 # --- UI layout ---------------------------------------------------------------
 st.title("GraphHopper Routing — Web UI")
@@ -92,11 +355,12 @@ if run_btn:
         st.error("Please provide a GraphHopper API key in the sidebar.")
     elif start_input.strip() == "" or end_input.strip() == "":
         st.error("Please provide both starting location and destination.")
+    elif not _validate_key(api_key):
+        st.error("Invalid GraphHopper API key. Check the key in the sidebar.")
     else:
-        with st.spinner("Geocoding start..."):
-            s_status, s_data = geocode_location(start_input, api_key)
-        with st.spinner("Geocoding destination..."):
-            d_status, d_data = geocode_location(end_input, api_key)
+        # geocode both ends in one batch so the two requests share a connection
+        with st.spinner("Geocoding..."):
+            (s_status, s_data), (d_status, d_data) = geocode_many([start_input, end_input], api_key)
 
         if s_status != 200 or d_status != 200:
             st.error(f"Geocoding failed: start_status={s_status}, dest_status={d_status}")
@@ -108,8 +372,15 @@ if run_btn:
             start_coords = (s_data["lat"], s_data["lng"])
             dest_coords = (d_data["lat"], d_data["lng"])
 
+            # no point asking for a route between identical points
+            if (math.isclose(start_coords[0], dest_coords[0], abs_tol=1e-6)
+                    and math.isclose(start_coords[1], dest_coords[1], abs_tol=1e-6)):
+                st.warning("Start and destination resolve to the same point.")
+                st.stop()
+
             with st.spinner("Requesting route..."):
-                r_status, r_json = get_route(start_coords, dest_coords, vehicle, api_key)
+                r_status, r_json, instr_df, r_bytes = get_route(start_coords, dest_coords, vehicle, api_key,
+                                                                want_polyline=True)
 
             if r_status != 200:
                 st.error(f"Routing failed (status {r_status}). See response below.")
@@ -151,39 +422,49 @@ if run_btn:
                     instr = path.get("instructions", [])
                     if instr:
                         st.subheader("Turn-by-turn instructions")
-                        for i, ins in enumerate(instr):
-                            txt = ins.get("text", "(no text)")
-                            dist = ins.get("distance", 0.0) / 1000.0  # km
-                            # time for that instruction (ms -> sec)
-                            ins_time_ms = ins.get("time", 0)
-                            tsec = int(ins_time_ms / 1000)
-                            th = tsec // 3600
-                            tm = (tsec % 3600) // 60
-                            ts = tsec % 60
-                            with st.expander(f"{i+1}. {txt} — {dist:.2f} km"):
-                                st.write(f"Distance: {dist:.3f} km / {(dist/1.609344):.3f} miles")
-                                st.write(f"Estimated time: {th:02d}:{tm:02d}:{ts:02d}")
-                                st.json(ins)
+                        # one table instead of an expander per step keeps long routes cheap to render
+                        st.dataframe(instr_df, use_container_width=True, hide_index=True)
+                        with st.expander("Raw instructions JSON"):
+                            st.json(instr)
 
                     else:
                         st.info("No step-by-step instructions available in the response.")
                         st.json(path)
 
-                    # Simple map showing start and end markers
+                    # Map showing the route line plus start and end markers
                     try:
-                        st.subheader("Map (Start & Destination)")
-                        df_map = pd.DataFrame(
-                            [{"lat": start_coords[0], "lon": start_coords[1], "label": "Start"},
-                             {"lat": dest_coords[0], "lon": dest_coords[1], "label": "Destination"}]
-                        )
-                        # st.map expects columns named 'lat' and 'lon' OR a DataFrame with numeric columns
-                        st.map(df_map.rename(columns={"lat": "lat", "lon": "lon"})[["lat", "lon"]])
+                        st.subheader("Map (Route)")
+                        # reuse the last marker frame while the coordinates are unchanged
+                        map_key = (start_coords, dest_coords)
+                        cached_key, df_map = st.session_state.get("_map_df", (None, None))
+                        if cached_key != map_key:
+                            df_map = pd.DataFrame({
+                                "lat": [start_coords[0], dest_coords[0]],
+                                "lon": [start_coords[1], dest_coords[1]],
+                                "label": ["Start", "Destination"],
+                            })
+                            st.session_state["_map_df"] = (map_key, df_map)
+                        layers = [pdk.Layer("ScatterplotLayer", df_map, get_position=["lon", "lat"],
+                                            get_fill_color=[220, 50, 50], get_radius=60,
+                                            radius_min_pixels=5, pickable=True)]
+                        route_coords = _route_coords(path)
+                        if route_coords is not None:
+                            route_path = route_coords.tolist()
+                            layers.insert(0, pdk.Layer("PathLayer", [{"path": route_path}],
+                                                       get_path="path", get_color=[30, 110, 220],
+                                                       get_width=4, width_min_pixels=3))
+                            view = pdk.data_utils.compute_view(route_path)
+                        else:
+                            view = pdk.data_utils.compute_view(df_map[["lon", "lat"]].values.tolist())
+                        st.pydeck_chart(pdk.Deck(layers=layers, initial_view_state=view,
+                                                 tooltip={"text": "{label}"}))
                         # also show a small table with labels
                         st.table(df_map)
                     except Exception as e:
                         st.warning(f"Could not render map: {e}")
 
-                    # Show raw response and allow download
-                    st.subheader("Raw routing JSON")
-                    st.download_button("Download JSON", data=str(r_json), file_name="graphhopper_route.json")
-                    st.json(r_json)
+                    # Allow download; keep the (potentially large) raw response collapsed by default
+                    st.download_button("Download JSON", data=r_bytes,
+                                       file_name="graphhopper_route.json", mime="application/json")
+                    with st.expander("Raw routing JSON", expanded=False):
+                        st.json(r_json)